@@ -1,56 +1,72 @@
 # config_from_spreadsheet.py
 import json
 import os
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from types import MappingProxyType
 import streamlit as st
+from sheets_client import execute_with_retry, get_sheets_service, load_credentials
+
+# 分析設定（不変のため共有）
+_ANALYSIS_SETTINGS = MappingProxyType({
+    "gsc_days_ago": 30,
+    "comparison_days_ago": 60,
+    "min_clicks_for_trend": 5,
+    "min_impressions_for_intent": 100,
+    "max_ctr_for_intent": 0.05,
+    "trend_change_threshold": 50,
+    "display_limit": 20
+})
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _fetch_sheet_values(spreadsheet_id, range_name, _service):
+    """シートの値を取得（Streamlitの再実行ごとのAPI呼び出しを10分間キャッシュ）"""
+    result = execute_with_retry(_service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=range_name
+    ))
+    return result.get('values', [])
 
 class SpreadsheetConfigLoader:
     def __init__(self, spreadsheet_id='1gwLASONia-UIaXuQV0S7nQn8oHpz7F_ONMC_rlAM15s'):
         self.spreadsheet_id = spreadsheet_id
         self.config_sheet_name = 'サイト設定'  # 新しいシート名
         self.credentials_file = 'credentials/gemini-analysis-467706-e19bcd6a67bb.json'
+        self._service = None
         
     def get_credentials(self):
         """認証情報を取得（Secrets対応）"""
         try:
-            # Secretsから読み込み
-            if 'gcp_service_account' in st.secrets:
-                credentials_dict = dict(st.secrets["gcp_service_account"])
-                credentials = service_account.Credentials.from_service_account_info(
-                    credentials_dict,
-                    scopes=['https://www.googleapis.com/auth/spreadsheets.readonly']
-                )
-                return credentials
-            else:
-                # ローカルファイルから読み込み
-                credentials = service_account.Credentials.from_service_account_file(
-                    self.credentials_file,
-                    scopes=['https://www.googleapis.com/auth/spreadsheets.readonly']
-                )
-                return credentials
+            return load_credentials(
+                ('https://www.googleapis.com/auth/spreadsheets.readonly',),
+                self.credentials_file
+            )
         except Exception as e:
             st.error(f"認証エラー: {e}")
             return None
+    
+    def get_service(self):
+        """Sheets APIクライアントを取得（初回のみ生成）"""
+        if self._service is None:
+            credentials = self.get_credentials()
+            if not credentials:
+                return None
+            self._service = get_sheets_service(credentials)
+        return self._service
         
     def load_sites_from_spreadsheet(self):
         """スプレッドシートからサイト情報を読み込む"""
         try:
-            # 認証
-            credentials = self.get_credentials()
-            if not credentials:
+            # 認証（クライアントは再利用）
+            service = self.get_service()
+            if not service:
                 return None
-                
-            service = build('sheets', 'v4', credentials=credentials)
             
             # スプレッドシートから読み込み
             # A列: サイト名, B列: URL, C列: GA4 ID, D列: 個別スプレッドシートID（オプション）
-            result = service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=f'{self.config_sheet_name}!A2:D100'  # ヘッダー行をスキップ
-            ).execute()
-            
-            values = result.get('values', [])
+            values = _fetch_sheet_values(
+                self.spreadsheet_id,
+                f'{self.config_sheet_name}!A2:D100',  # ヘッダー行をスキップ
+                service
+            )
             sites = []
             
             for row in values:
@@ -76,14 +92,6 @@ class SpreadsheetConfigLoader:
             "credentials_file": "credentials/gemini-analysis-467706-e19bcd6a67bb.json",
             "default_spreadsheet_id": self.spreadsheet_id,
             "sites": sites,
-            "analysis_settings": {
-                "gsc_days_ago": 30,
-                "comparison_days_ago": 60,
-                "min_clicks_for_trend": 5,
-                "min_impressions_for_intent": 100,
-                "max_ctr_for_intent": 0.05,
-                "trend_change_threshold": 50,
-                "display_limit": 20
-            }
+            "analysis_settings": _ANALYSIS_SETTINGS
         }
         return config
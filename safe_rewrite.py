@@ -10,10 +10,18 @@ Geminiを用いた“安全リライト”ユーティリティ
 from __future__ import annotations
 import re
 import difflib
+import itertools
+import json
 import time
-from typing import Dict, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple, Optional, Set
 import google.generativeai as genai
 
+try:
+    import ahocorasick  # pyahocorasick（未導入時は部分文字列検索にフォールバック）
+except ImportError:
+    ahocorasick = None
+
 # ====== 抽出ユーティリティ ======
 
 URL_RE = re.compile(r"https?://[^\s)<>\"']+")
@@ -21,25 +29,61 @@ NUM_RE = re.compile(r"[-+]?\d+(?:[.,]\d+)?%?")
 DATE_RE = re.compile(r"(20\d{2}[/.-]\d{1,2}[/.-]\d{1,2}|20\d{2}年\d{1,2}月\d{1,2}日)")
 # “固有名詞らしさ”簡易抽出：カタカナ語/アルファベット語/長めの漢字語
 NE_RE = re.compile(r"[A-Za-z][A-Za-z0-9\-_/]+|[ァ-ンヴー]{2,}|[一-龥]{2,}")
+# 種別ごとの抽出パターンと上限（種別間の重なりは許容：URL内の数値なども各種別で数える）
+FACT_PATTERNS = {"urls": URL_RE, "numbers": NUM_RE, "dates": DATE_RE, "entities": NE_RE}
+FACT_LIMITS = {"urls": 50, "numbers": 100, "dates": 50, "entities": 100}
+
+def _dedupe_cap(matches, limit: int) -> List[str]:
+    """出現順に重複を除いて先頭limit件を採用（上限に達したら残りは走査しない）"""
+    seen: Set[str] = set()
+    found: List[str] = []
+    for m in matches:
+        value = m.group(0)
+        if value in seen:
+            continue
+        seen.add(value)
+        found.append(value)
+        if len(found) >= limit:
+            break
+    return found
 
 def extract_key_facts(text: str) -> Dict[str, List[str]]:
     """元記事から“保持すべき要素”候補を抽出（簡易ルールベース）"""
-    urls = list(dict.fromkeys(URL_RE.findall(text)))
-    nums = list(dict.fromkeys(NUM_RE.findall(text)))
-    dates = list(dict.fromkeys(DATE_RE.findall(text)))
-    nes = list(dict.fromkeys([m.group(0) for m in NE_RE.finditer(text)]))
     return {
-        "urls": urls[:50],
-        "numbers": nums[:100],
-        "dates": dates[:50],
-        "entities": nes[:100],
+        name: _dedupe_cap(rx.finditer(text), FACT_LIMITS[name])
+        for name, rx in FACT_PATTERNS.items()
     }
 
-def coverage_score(baseline: List[str], rewritten: str) -> float:
-    """保持率スコア（0-1）。要素が多すぎると過剰判定になるので上限でクリップ。"""
+def build_fact_matcher(facts: Dict[str, List[str]]) -> Any:
+    """抽出要素をまとめて検索するAho-Corasickオートマトンを構築（リトライ間で使い回す）"""
+    keys = {x for values in facts.values() for x in values if x}
+    if ahocorasick is None or not keys:
+        return frozenset(keys)
+    automaton = ahocorasick.Automaton()
+    for key in keys:
+        automaton.add_word(key, key)
+    automaton.make_automaton()
+    return automaton
+
+def find_present_facts(matcher: Any, text: str) -> Set[str]:
+    """text中に出現する要素の集合を1回の走査で求める"""
+    if isinstance(matcher, frozenset):
+        return {x for x in matcher if x in text}
+    return {key for _, key in matcher.iter(text)}
+
+def fact_overlap(facts: Dict[str, List[str]]) -> int:
+    """チャンク境界をまたぐ要素を取りこぼさないために重ねて走査する文字数"""
+    return max((len(x) for values in facts.values() for x in values), default=1) - 1
+
+def coverage_score(baseline: List[str], rewritten: str, present: Optional[Set[str]] = None) -> float:
+    """保持率スコア（0-1）。要素が多すぎると過剰判定になるので上限でクリップ。
+    present（rewritten中に出現した要素集合）を渡すと部分文字列検索を省略する。"""
     if not baseline:
         return 1.0
-    kept = sum(1 for x in baseline if x and x in rewritten)
+    if present is None:
+        kept = sum(1 for x in baseline if x and x in rewritten)
+    else:
+        kept = sum(1 for x in baseline if x and x in present)
     return kept / max(5, min(len(baseline), 100))
 
 # ====== Gemini呼び出し ======
@@ -48,7 +92,15 @@ def init_gemini(api_key: str, model: str = "gemini-1.5-flash"):
     genai.configure(api_key=api_key)
     return genai.GenerativeModel(model)
 
+# プロンプトに含める元記事の最大文字数
+PROMPT_TEXT_LIMIT = 18000
+
+def truncate_for_prompt(text: str) -> str:
+    """プロンプト用に元記事を切り詰める（safe_rewrite内で1度だけ実行）"""
+    return text[:PROMPT_TEXT_LIMIT]
+
 def prompt_extract_must_keep(original_text: str) -> str:
+    """original_textは切り詰め済み（truncate_for_prompt）を渡す"""
     return f"""
 あなたは編集監修者です。以下の元記事から『保持必須要素』を箇条書きで抽出してください。
 - 事実・数値・日付・固有名詞・商品名・法的注意・免責・内部/外部リンクの要点
@@ -65,18 +117,19 @@ def prompt_extract_must_keep(original_text: str) -> str:
 }}
 
 # 元記事
-{original_text[:18000]}
+{original_text}
 """
 
-def prompt_rewrite_with_constraints(
+def rewrite_prompt_parts(
     keyword: str,
     original_text: str,
     ai_suggestions: str,
-    must_keep_json: str,
     style_guidelines: Optional[str] = None
-) -> str:
+) -> Tuple[str, str]:
+    """リライト用プロンプトの不変部分（保持必須要素JSONの前後）を組み立てる
+    original_textは切り詰め済み（truncate_for_prompt）を渡す"""
     style = style_guidelines or "・冗長回避・具体/簡潔・事実改変禁止・トーンは既存踏襲・見出しは検索意図に整合"
-    return f"""
+    head = f"""
 あなたはSEOライティングの専門家です。下記の条件を**すべて満たす**形で、元記事を改良してください。
 
 # 制約
@@ -92,32 +145,113 @@ def prompt_rewrite_with_constraints(
 {keyword}
 
 # 保持必須要素（JSON）
-{must_keep_json}
+"""
+    tail = f"""
 
 # 改善案（AI提案）
 {ai_suggestions}
 
 # 元記事（全文）
-{original_text[:18000]}
+{original_text}
 
 # スタイル指針
 {style}
 """
+    return head, tail
+
+def prompt_rewrite_with_constraints(
+    keyword: str,
+    original_text: str,
+    ai_suggestions: str,
+    must_keep_json: str,
+    style_guidelines: Optional[str] = None
+) -> str:
+    """original_textは切り詰め済み（truncate_for_prompt）を渡す"""
+    head, tail = rewrite_prompt_parts(keyword, original_text, ai_suggestions, style_guidelines)
+    return "".join((head, must_keep_json, tail))
+
+# 正常終了とみなす終了理由（それ以外はブロック等による打ち切り）
+_NORMAL_FINISH_REASONS = {"STOP", "MAX_TOKENS"}
+
+def _chunk_text(chunk) -> str:
+    """ストリーミングのチャンクから本文を取り出す
+    本文を含まないだけのチャンクは空文字、ブロック/安全性等で打ち切られた場合はValueErrorを送出"""
+    candidates = chunk.candidates
+    if not candidates:
+        # プロンプト自体がブロックされた場合
+        raise ValueError(f"Geminiの応答がブロックされました: {chunk.prompt_feedback}")
+    candidate = candidates[0]
+    reason = candidate.finish_reason
+    if reason and getattr(reason, "name", None) not in _NORMAL_FINISH_REASONS:
+        raise ValueError(f"Geminiの応答が途中で打ち切られました: finish_reason={getattr(reason, 'name', reason)}")
+    if not candidate.content.parts:
+        return ""
+    return chunk.text
+
+def generate_streaming(gemini_model, prompt: str, matcher: Any, overlap: int) -> Tuple[str, Set[str]]:
+    """Geminiの応答をストリーミングで受信し、受信と並行して保持要素の出現を検出
+    Returns:
+        text, present（textに出現した要素の集合）
+    """
+    parts: List[str] = []
+    present: Set[str] = set()
+    total = len(matcher)
+    tail = ""
+    for chunk in gemini_model.generate_content(prompt, stream=True):
+        text = _chunk_text(chunk)
+        if not text:
+            continue
+        parts.append(text)
+        if len(present) >= total:
+            # 全要素を検出済みなら残りのチャンクは走査不要
+            continue
+        window = tail + text
+        present |= find_present_facts(matcher, window)
+        tail = window[-overlap:] if overlap > 0 else ""
+    return "".join(parts), present
+
+def local_must_keep_json(facts: Dict[str, List[str]]) -> str:
+    """ルールベース抽出結果を保持必須要素JSONの形に整形（Gemini抽出の代用）"""
+    return json.dumps({
+        "numbers": facts["numbers"],
+        "dates": facts["dates"],
+        "entities": facts["entities"],
+        "links": facts["urls"],
+    }, ensure_ascii=False)
 
 # ====== 検証・リトライ ======
 
-def validate_rewrite(original: str, rewritten_html: str) -> Dict[str, float]:
-    """改悪防止のための簡易スコアリング"""
-    base = extract_key_facts(original)
+def non_space_len(text: str) -> int:
+    """空白（全角スペース等のUnicode空白を含む）を除いた文字数。正規表現の空白除去と同じ結果"""
+    return sum(map(len, text.split()))
+
+def validate_rewrite(
+    original: str,
+    rewritten_html: str,
+    matcher: Any = None,
+    base: Optional[Dict[str, List[str]]] = None,
+    orig_len: Optional[int] = None,
+    present: Optional[Set[str]] = None,
+) -> Dict[str, float]:
+    """改悪防止のための簡易スコアリング
+    base/orig_len/matcherは元記事から事前計算した値を渡せる（リトライ時の再計算を省略）
+    present（ストリーミング中に検出済みの要素集合）を渡すとrewritten_htmlの再走査を省略"""
+    if base is None:
+        base = extract_key_facts(original)
+    if present is None:
+        if matcher is None:
+            matcher = build_fact_matcher(base)
+        present = find_present_facts(matcher, rewritten_html)
     scores = {
-        "url_keep": coverage_score(base["urls"], rewritten_html),
-        "num_keep": coverage_score(base["numbers"], rewritten_html),
-        "date_keep": coverage_score(base["dates"], rewritten_html),
-        "ent_keep": coverage_score(base["entities"], rewritten_html),
+        "url_keep": coverage_score(base["urls"], rewritten_html, present),
+        "num_keep": coverage_score(base["numbers"], rewritten_html, present),
+        "date_keep": coverage_score(base["dates"], rewritten_html, present),
+        "ent_keep": coverage_score(base["entities"], rewritten_html, present),
     }
     # 粗い文字数下限（過剰圧縮の検知）
-    orig_len = len(re.sub(r"\s+", "", original))
-    new_len = len(re.sub(r"\s+", "", rewritten_html))
+    if orig_len is None:
+        orig_len = non_space_len(original)
+    new_len = non_space_len(rewritten_html)
     length_ratio = new_len / max(1, orig_len)
     scores["length_ratio"] = length_ratio
     return scores
@@ -132,12 +266,19 @@ def is_pass(scores: Dict[str, float],
         scores["length_ratio"] >= len_min
     )
 
-def diff_preview(original: str, rewritten: str, n: int = 3) -> str:
-    """人間確認用の差分（行単位）"""
-    diff = difflib.unified_diff(
+def iter_diff_preview(original: str, rewritten: str, n: int = 3) -> Iterator[str]:
+    """人間確認用の差分を1行ずつ生成（必要な分だけ計算される）"""
+    return difflib.unified_diff(
         original.splitlines(), rewritten.splitlines(),
         lineterm="", n=n
     )
+
+def diff_preview(original: str, rewritten: str, n: int = 3, max_lines: Optional[int] = None) -> str:
+    """人間確認用の差分（行単位）。UI表示専用で、safe_rewriteの検証では使わない。
+    max_linesを指定すると先頭から指定行数で打ち切る。"""
+    diff = iter_diff_preview(original, rewritten, n)
+    if max_lines is not None:
+        diff = itertools.islice(diff, max_lines)
     return "\n".join(diff)
 
 # ====== 外部IF：1関数で安全リライト ======
@@ -153,25 +294,49 @@ def safe_rewrite(
 ) -> Tuple[str, Dict[str, float], str]:
     """
     1. 保持必須要素（Gemini JSON）を抽出
+       ※ 初回リライトはルールベース抽出結果で並行して開始
     2. その制約＋改善案でリライト生成
     3. 差分検証。閾値未達なら自動で再生成（最大max_retries）
 
     Returns:
         rewritten_html, scores, must_keep_json
     """
-    # 1) 抽出
-    keep_resp = gemini_model.generate_content(prompt_extract_must_keep(original_html_or_text))
-    must_keep_json = keep_resp.text
+    # 元記事側の検証材料（抽出要素・オートマトン・文字数）は1度だけ計算
+    base = extract_key_facts(original_html_or_text)
+    matcher = build_fact_matcher(base)
+    overlap = fact_overlap(base)
+    orig_len = non_space_len(original_html_or_text)
+    # プロンプト用の元記事は1度だけ切り詰めて各プロンプトで共有
+    prompt_text = truncate_for_prompt(original_html_or_text)
+    # リライトプロンプトの不変部分も1度だけ組み立て、保持必須要素JSONのみ差し替える
+    prompt_head, prompt_tail = rewrite_prompt_parts(
+        keyword, prompt_text, ai_suggestions_text, style_guidelines
+    )
+
+    # 1) 抽出と初回リライトを並行実行（Gemini往復1回分の待ち時間を削減）
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        keep_future = executor.submit(
+            gemini_model.generate_content, prompt_extract_must_keep(prompt_text)
+        )
+        first_future = executor.submit(
+            generate_streaming,
+            gemini_model,
+            "".join((prompt_head, local_must_keep_json(base), prompt_tail)),
+            matcher,
+            overlap,
+        )
+        must_keep_json = keep_future.result().text
+        first_result = first_future.result()
 
-    # 2) 生成 + 3) 検証&リトライ
+    # 2) 生成 + 3) 検証&リトライ（2回目以降はGeminiの抽出結果を使用）
+    prompt = "".join((prompt_head, must_keep_json, prompt_tail))
     last_scores = {}
     for attempt in range(max_retries + 1):
-        prompt = prompt_rewrite_with_constraints(
-            keyword, original_html_or_text, ai_suggestions_text, must_keep_json, style_guidelines
-        )
-        resp = gemini_model.generate_content(prompt)
-        rewritten = resp.text or ""
-        last_scores = validate_rewrite(original_html_or_text, rewritten)
+        if attempt == 0:
+            rewritten, present = first_result
+        else:
+            rewritten, present = generate_streaming(gemini_model, prompt, matcher, overlap)
+        last_scores = validate_rewrite(original_html_or_text, rewritten, matcher, base, orig_len, present)
 
         if is_pass(last_scores):
             return rewritten, last_scores, must_keep_json
@@ -185,11 +350,10 @@ def safe_rewrite(
 - 固有名詞は必ず残す（表記ゆれ禁止）
 - 全体の長さは原文の{int(100*max(0.6, last_scores.get('length_ratio', 0)))}%以上
 """
-        retry_prompt = prompt + "\n\n# フィードバック（必ず反映）\n" + feedback
+        retry_prompt = "".join((prompt, "\n\n# フィードバック（必ず反映）\n", feedback))
         time.sleep(sleep_sec)
-        resp = gemini_model.generate_content(retry_prompt)
-        rewritten = resp.text or ""
-        last_scores = validate_rewrite(original_html_or_text, rewritten)
+        rewritten, present = generate_streaming(gemini_model, retry_prompt, matcher, overlap)
+        last_scores = validate_rewrite(original_html_or_text, rewritten, matcher, base, orig_len, present)
         if is_pass(last_scores):
             return rewritten, last_scores, must_keep_json
 
@@ -199,6 +363,31 @@ def safe_rewrite(
 # ====== 例：WP下書きに送る（任意） ======
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def _create_wp_session() -> requests.Session:
+    """WP REST API用の共有セッション（keep-aliveで接続を再利用、一時的なエラーは再試行）"""
+    session = requests.Session()
+    # 投稿作成(POST)は非冪等なので、未処理が確実な接続エラーと429/503のみ再試行
+    # （送信後の読み取りエラー・タイムアウトは再試行しない＝下書きの重複防止）
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        other=0,
+        status=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+_WP_SESSION = _create_wp_session()
 
 def push_to_wordpress_draft(
     wp_base: str, user: str, app_password: str,
@@ -206,7 +395,7 @@ def push_to_wordpress_draft(
 ) -> str:
     """WP REST APIで下書き作成。成功時は投稿URLを返す"""
     url = wp_base.rstrip("/") + "/wp-json/wp/v2/posts"
-    r = requests.post(
+    r = _WP_SESSION.post(
         url,
         auth=(user, app_password),
         json={"title": title, "content": html, "status": status},
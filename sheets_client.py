@@ -0,0 +1,78 @@
+import functools
+import random
+import threading
+import time
+import google_auth_httplib2
+import httplib2
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+import streamlit as st
+
+# 再試行対象のステータス（レート制限・一時的なサーバーエラー）
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_TRIES = 5
+
+
+@functools.lru_cache(maxsize=4)
+def load_credentials(scopes, credentials_file=None):
+    """サービスアカウント認証情報を読み込む（Secrets優先。スコープごとにキャッシュし鍵の再解析を省略）"""
+    if 'gcp_service_account' in st.secrets:
+        # Secretsから読み込み
+        return service_account.Credentials.from_service_account_info(
+            dict(st.secrets["gcp_service_account"]),
+            scopes=list(scopes)
+        )
+    # ローカルファイルから読み込み
+    return service_account.Credentials.from_service_account_file(
+        credentials_file,
+        scopes=list(scopes)
+    )
+
+
+def credentials_cache_key(credentials):
+    """認証情報からキャッシュキーを生成（サービスアカウント＋スコープ）"""
+    email = getattr(credentials, 'service_account_email', None)
+    scopes = tuple(sorted(getattr(credentials, 'scopes', None) or ()))
+    return f"{email}|{','.join(scopes)}"
+
+
+@st.cache_resource(show_spinner=False)
+def _build_sheets_service(cache_key, _credentials):
+    """Sheets APIクライアントを生成（Discovery文書は同梱版を使用）
+    クライアントは全セッション（スレッド）で共有されるが、httplib2.Httpは
+    スレッドセーフでないため、HTTPトランスポートはスレッドごとに1つ持ち
+    同一スレッド内ではkeep-alive接続を再利用する"""
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        thread_http = getattr(local, 'http', None)
+        if thread_http is None:
+            thread_http = google_auth_httplib2.AuthorizedHttp(_credentials, http=httplib2.Http())
+            local.http = thread_http
+        return HttpRequest(thread_http, *args, **kwargs)
+
+    return build(
+        'sheets', 'v4',
+        http=google_auth_httplib2.AuthorizedHttp(_credentials, http=httplib2.Http()),
+        requestBuilder=build_request,
+        cache_discovery=False,
+        static_discovery=True
+    )
+
+
+def get_sheets_service(credentials):
+    """Sheets APIクライアントを取得（同じ認証情報なら再利用）"""
+    return _build_sheets_service(credentials_cache_key(credentials), credentials)
+
+
+def execute_with_retry(request, tries=MAX_TRIES, retry_statuses=RETRY_STATUSES):
+    """APIリクエストを実行（429/5xxは指数バックオフ＋ジッターで再試行）"""
+    for attempt in range(tries):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status not in retry_statuses or attempt == tries - 1:
+                raise
+            time.sleep((2 ** attempt) + random.random())
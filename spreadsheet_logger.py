@@ -1,35 +1,53 @@
 import json
+import atexit
+import socket
+import threading
+import time
+import weakref
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import httplib2
+from googleapiclient.errors import HttpError
 import streamlit as st
 import os
+from sheets_client import execute_with_retry, get_sheets_service, load_credentials
+
+# 履歴書き込みのバッファ設定（行数 or 経過秒数で一括送信）
+FLUSH_MAX_ROWS = 20
+FLUSH_INTERVAL_SEC = 10
+# 履歴読み込み時に1回で取得する行数（limitの倍数）
+HISTORY_WINDOW_FACTOR = 5
+# 送信前に失敗したことが確実な（再送しても重複しない）通信エラー
+UNSENT_ERRORS = (ConnectionRefusedError, socket.gaierror, httplib2.ServerNotFoundError)
+
+# 終了時に未送信の行を送るため、生存中のロガーを弱参照で保持
+_live_loggers = weakref.WeakSet()
+
+@atexit.register
+def _flush_all_loggers():
+    """プロセス終了時に全ロガーのバッファを送信"""
+    for logger in list(_live_loggers):
+        logger.flush()
 
 class SpreadsheetLogger:
     def __init__(self, config):
         self.config = config
         self.sheets_service = None
         self.spreadsheet_id = config.get('default_spreadsheet_id')
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+        self._last_flush = time.time()
+        self._flush_failed = False
         self.init_sheets_service()
+        _live_loggers.add(self)
     
     def get_credentials(self):
         """認証情報を取得（Secrets対応）"""
         try:
-            # Secretsから読み込み
-            if 'gcp_service_account' in st.secrets:
-                credentials_dict = dict(st.secrets["gcp_service_account"])
-                credentials = service_account.Credentials.from_service_account_info(
-                    credentials_dict,
-                    scopes=['https://www.googleapis.com/auth/spreadsheets']
-                )
-                return credentials
-            else:
-                # ローカルファイルから読み込み
-                credentials = service_account.Credentials.from_service_account_file(
-                    self.config['credentials_file'],
-                    scopes=['https://www.googleapis.com/auth/spreadsheets']
-                )
-                return credentials
+            return load_credentials(
+                ('https://www.googleapis.com/auth/spreadsheets',),
+                self.config.get('credentials_file')
+            )
         except Exception as e:
             st.error(f"認証エラー: {e}")
             return None
@@ -41,7 +59,7 @@ class SpreadsheetLogger:
             if not credentials:
                 return
                 
-            self.sheets_service = build('sheets', 'v4', credentials=credentials)
+            self.sheets_service = get_sheets_service(credentials)
             
             # 履歴シートを作成/確認
             self.ensure_history_sheet()
@@ -51,44 +69,53 @@ class SpreadsheetLogger:
     def ensure_history_sheet(self):
         """履歴シートが存在しなければ作成"""
         try:
-            # 既存のシート一覧を取得
-            sheet_metadata = self.sheets_service.spreadsheets().get(
-                spreadsheetId=self.spreadsheet_id
-            ).execute()
+            # 既存のシート一覧を取得（タイトルとIDのみ）
+            sheet_metadata = execute_with_retry(self.sheets_service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                fields='sheets.properties(sheetId,title)'
+            ))
             
             sheets = sheet_metadata.get('sheets', [])
             sheet_names = [s['properties']['title'] for s in sheets]
             
             if 'SEO分析履歴' not in sheet_names:
-                # シートを追加
+                # シート追加とヘッダー行の書き込みを1回のbatchUpdateで実行
+                sheet_id = max([s['properties'].get('sheetId', 0) for s in sheets], default=0) + 1
+                headers = ['タイムスタンプ', 'サイト', 'ユーザー', 'キーワード', 'URL', 'モード', '分析結果']
                 request = {
-                    'requests': [{
-                        'addSheet': {
-                            'properties': {
-                                'title': 'SEO分析履歴'
+                    'requests': [
+                        {
+                            'addSheet': {
+                                'properties': {
+                                    'sheetId': sheet_id,
+                                    'title': 'SEO分析履歴'
+                                }
+                            }
+                        },
+                        {
+                            'updateCells': {
+                                'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                                'rows': [{
+                                    'values': [{'userEnteredValue': {'stringValue': h}} for h in headers]
+                                }],
+                                'fields': 'userEnteredValue'
                             }
                         }
-                    }]
+                    ]
                 }
-                self.sheets_service.spreadsheets().batchUpdate(
+                # addSheetは冪等でないため429のみ再試行（5xxは作成済みの可能性がある）
+                execute_with_retry(self.sheets_service.spreadsheets().batchUpdate(
                     spreadsheetId=self.spreadsheet_id,
                     body=request
-                ).execute()
-                
-                # ヘッダー行を追加
-                headers = [['タイムスタンプ', 'サイト', 'ユーザー', 'キーワード', 'URL', 'モード', '分析結果']]
-                self.sheets_service.spreadsheets().values().update(
-                    spreadsheetId=self.spreadsheet_id,
-                    range='SEO分析履歴!A1:G1',
-                    valueInputOption='RAW',
-                    body={'values': headers}
-                ).execute()
+                ), retry_statuses=(429,))
                 
         except Exception as e:
             st.error(f"シート作成エラー: {e}")
     
     def save_analysis(self, keyword, url, analysis, mode):
-        """分析結果をスプレッドシートに保存"""
+        """分析結果を書き込みバッファに追加（まとめてスプレッドシートに保存）"""
+        if not self.sheets_service:
+            return None
         try:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             user_name = os.environ.get('USERNAME', 'unknown')
@@ -97,17 +124,27 @@ class SpreadsheetLogger:
             # 分析結果を短縮（スプレッドシートのセル制限対策）
             analysis_short = analysis[:5000] if len(analysis) > 5000 else analysis
             
-            # 新しい行のデータ
-            new_row = [[timestamp, site_name, user_name, keyword, url, mode, analysis_short]]
+            # 新しい行のデータ（ローカル退避用に短縮前の分析結果も保持）
+            new_row = [timestamp, site_name, user_name, keyword, url, mode, analysis_short]
+            entry = (new_row, analysis)
             
-            # シートに追加
-            self.sheets_service.spreadsheets().values().append(
-                spreadsheetId=self.spreadsheet_id,
-                range='SEO分析履歴!A:G',
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body={'values': new_row}
-            ).execute()
+            # 閾値に達していれば（前回送信が失敗していれば）即時送信、それ以外はバッファに追加
+            with self._pending_lock:
+                flush_now = (
+                    self._flush_failed or
+                    len(self._pending) + 1 >= FLUSH_MAX_ROWS or
+                    time.time() - self._last_flush >= FLUSH_INTERVAL_SEC
+                )
+                if not flush_now:
+                    self._pending.append(entry)
+            
+            if flush_now:
+                if not self.flush(extra=entry):
+                    # この行は呼び出し側のローカル保存に任せる
+                    st.error("スプレッドシート保存エラー: 送信に失敗しました")
+                    return None
+            else:
+                self._schedule_flush()
             
             return f"{timestamp}_{keyword}"
             
@@ -115,38 +152,145 @@ class SpreadsheetLogger:
             st.error(f"スプレッドシート保存エラー: {e}")
             return None
     
+    def _schedule_flush(self):
+        """一定時間後にバッファを送信するタイマーを起動"""
+        with self._pending_lock:
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(FLUSH_INTERVAL_SEC, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+    
+    def flush(self, extra=None):
+        """バッファ内の行を1回のappendでまとめて保存（成功または送信不要ならTrue）
+        extraは呼び出し元の行で、失敗時はバッファに戻さず呼び出し元に処理を任せる"""
+        with self._pending_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            entries, self._pending = self._pending, []
+        
+        batch = entries + [extra] if extra is not None else entries
+        if not batch or not self.sheets_service:
+            return True
+        
+        try:
+            self._append_rows([row for row, _ in batch])
+        except Exception as e:
+            # タイマースレッドからも呼ばれるためprintで通知
+            print(f"スプレッドシート保存エラー: {e}")
+            retryable = (
+                (isinstance(e, HttpError) and e.resp.status == 429) or
+                isinstance(e, UNSENT_ERRORS)
+            )
+            # 次回のsave_analysisは即時送信し、失敗を呼び出し元に返す
+            with self._pending_lock:
+                self._flush_failed = True
+            if retryable:
+                # 未送信が確実な失敗のみバッファに戻してタイマーで再送
+                with self._pending_lock:
+                    self._pending = entries + self._pending
+                self._schedule_flush()
+            else:
+                # 書き込み済みの可能性・恒久的なエラーは再送せずローカルに退避
+                self._save_locally(entries)
+            return False
+        
+        with self._pending_lock:
+            self._last_flush = time.time()
+            self._flush_failed = False
+        return True
+    
+    def _save_locally(self, entries):
+        """送信できなかった行をローカル保存（save_analysis_resultのフォールバックと同じ形式）"""
+        if not entries:
+            return
+        try:
+            os.makedirs("analysis_log", exist_ok=True)
+            for (timestamp, site_name, user_name, keyword, url, mode, _), analysis in entries:
+                file_timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d_%H%M%S")
+                safe_keyword = keyword.replace(' ', '_').replace('/', '_')
+                filename = f"{site_name.replace(' ', '_')}_{file_timestamp}_{user_name}_{safe_keyword}.json"
+                
+                data = {
+                    "timestamp": timestamp,
+                    "keyword": keyword,
+                    "url": url,
+                    "analysis": analysis,
+                    "mode": mode,
+                    "user": user_name,
+                    "site": site_name
+                }
+                
+                with open(f"analysis_log/{filename}", 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"ローカル保存エラー: {e}")
+    
+    def _append_rows(self, rows):
+        """複数行を追記（429のみ再試行。5xxは書き込み済みの可能性があり重複を避ける）"""
+        request = self.sheets_service.spreadsheets().values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range='SEO分析履歴!A:G',
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': rows}
+        )
+        return execute_with_retry(request, retry_statuses=(429,))
+    
     def load_history(self, site_name=None, limit=20):
         """スプレッドシートから履歴を読み込み"""
+        # 未送信の行を先に反映
+        self.flush()
         try:
-            # データを取得
-            result = self.sheets_service.spreadsheets().values().get(
+            # 最終行を把握するためA列（タイムスタンプ）のみ取得
+            # ※ gridProperties.rowCountは空行を含むグリッドサイズなので使わない
+            column = execute_with_retry(self.sheets_service.spreadsheets().values().get(
                 spreadsheetId=self.spreadsheet_id,
-                range='SEO分析履歴!A:G'
-            ).execute()
+                range='SEO分析履歴!A:A',
+                majorDimension='COLUMNS'
+            ))
             
-            values = result.get('values', [])
-            if len(values) <= 1:  # ヘッダーのみ
+            columns = column.get('values', [])
+            last_row = len(columns[0]) if columns else 0
+            if last_row <= 1:  # ヘッダーのみ
                 return []
             
-            # データを辞書形式に変換（ヘッダーを除く）
+            # 末尾から必要な範囲だけを取得（足りなければ範囲を広げて遡る）
             history = []
-            for row in reversed(values[1:]):  # 新しい順
-                if len(row) >= 7:
-                    data = {
-                        'timestamp': row[0],
-                        'site': row[1],
-                        'user': row[2],
-                        'keyword': row[3],
-                        'url': row[4],
-                        'mode': row[5],
-                        'analysis': row[6]
-                    }
-                    
-                    # サイト名でフィルタ
-                    if site_name is None or data['site'] == site_name:
-                        history.append(data)
-                        if len(history) >= limit:
-                            break
+            end = last_row
+            window = max(1, limit) * HISTORY_WINDOW_FACTOR
+            while end >= 2 and len(history) < limit:
+                start = max(2, end - window + 1)
+                result = execute_with_retry(self.sheets_service.spreadsheets().values().get(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f'SEO分析履歴!A{start}:G{end}',
+                    majorDimension='ROWS'
+                ))
+                
+                values = result.get('values', [])
+                values.reverse()  # 新しい順
+                
+                # データを辞書形式に変換
+                for row in values:
+                    if len(row) >= 7:
+                        data = {
+                            'timestamp': row[0],
+                            'site': row[1],
+                            'user': row[2],
+                            'keyword': row[3],
+                            'url': row[4],
+                            'mode': row[5],
+                            'analysis': row[6]
+                        }
+                        
+                        # サイト名でフィルタ
+                        if site_name is None or data['site'] == site_name:
+                            history.append(data)
+                            if len(history) >= limit:
+                                break
+                
+                end = start - 1
+                window *= 2
             
             return history
             